@@ -5,17 +5,15 @@ NAME
     fermi_helper.py - Build and run Fermi HEP workflow using Docker/Singularity
 
 SYNOPSIS
-    python3 fermi_helper.py build-docker-image [--tag TAG]
-        [--only-dependencies] [--pull-dependencies TAG] [--decaf-root ROOT]
-        [--decaf-repo REPO] [--decaf-repo-branch BRANCH]
+    python3 fermi_helper.py build-docker-image [--tag TAG] [--platform PLATFORM]
+        [--only-dependencies] [--pull-dependencies TAG] [--tag-dependencies TAG]
+        [--decaf-root ROOT] [--decaf-repo REPO] [--decaf-repo-branch BRANCH]
+        [--update-decaf] [--warm-cache]
     python3 fermi_helper.py run-docker-image [--tag TAG] [--interactive]
     python3 fermi_helper.py build-singularity-image [--tag TAG] [--sif SIF]
     python3 fermi_helper.py run-singularity-image [--sif SIF] [--interactive]
 
 EXAMPLE
-    Install Python dependency to run this script
-        $ python3 -m pip install --user jinja2
-
     Build the Docker image, using pre-built dependencies
         $ python3 fermi_helper.py build-docker-image --pull-dependencies thobson2/decaf-fermi:0.2.0-base
 
@@ -25,6 +23,13 @@ EXAMPLE
     Build the dependencies and push them to DockerHub
         $ python3 fermi_helper.py build-docker-image --only-dependencies --tag USERNAME/decaf-fermi:0.2.0-base
 
+    Refresh the build cache on DockerHub without building an image (e.g. from
+    a nightly CI job)
+        $ python3 fermi_helper.py build-docker-image --only-dependencies --warm-cache --tag USERNAME/decaf-fermi:0.2.0-base
+
+    Build the Docker image and push both it and its dependencies to DockerHub
+        $ python3 fermi_helper.py build-docker-image --tag USERNAME/decaf-fermi:0.2.0 --tag-dependencies USERNAME/decaf-fermi:0.2.0-base
+
     Run a shell within the Docker container interactively
     	$ python3 fermi_helper.py run-docker-image --interactive
 	docker$ mpirun --hostfile 
@@ -69,8 +74,8 @@ DEBUGGING
         docker$ vi new_box.py  # nothing to change here
 
     Now each command line can be run directly, after adding "python" to the
-    beginning, for example (the exact directories will be different)
-        docker$ python ./converter.py converter-henson.h5 /tmp/tmp.OrAXakGCKI/stage/examples/fermi_hep/deleteMe/
+    beginning, for example
+        docker$ python ./converter.py converter-henson.h5 ../../examples/fermi_hep/deleteMe/
         docker$ python ./approx.py converter-henson.h5 henson_approx.json
         docker$ python ./chi2.py henson_approx.json exerimental_data.json
         docker$ python ./new_box.py henson_approx.json.minimization newbox.json
@@ -86,8 +91,10 @@ DESCRIPTION
     The build does everything within a container, which means that the entire
     build process happens inside of Docker, and the image is, in a sense,
     hermetically sealed away from the host system. The catch is that any change
-    to source code requires a complete re-build of all of Decaf and the
-    workflow, which can take up to 5 minutes.
+    to C++ source code requires a complete re-build of all of Decaf and the
+    workflow, which can take up to 5 minutes. Changes to only Python source
+    code reuse the compiled C++ layers, and only re-run the build steps that
+    use the Python files, such as installing them.
 
     Either build process happens within Docker first and uses a Dockerfile to
     define the commands to be run. This Docker image can be used directly, or
@@ -109,9 +116,15 @@ DESCRIPTION
 OPTIONS
     --tag TAG
         Set the Docker image tag to be used. If named something like
-        USERNAME/IMAGENAME:VERSION, then the image will be pushed to a Docker
-        registry afterwards. Otherwise, a name like IMAGENAME:VERSION will only
-        be saved locally.
+        USERNAME/IMAGENAME:VERSION, then the image will be used as a build
+        cache, and pushed to a Docker registry afterwards. Otherwise, a name
+        like IMAGENAME:VERSION will only be saved locally.
+
+    --platform PLATFORM
+        Set the platform to build the Docker image for. Defaults to the
+        platform of the host, e.g. linux/amd64, because building for any other
+        platform runs under emulation and is several times slower. If the
+        host's architecture isn't recognized, Docker's default is used.
 
     --sif SIF
         Set the path to the Singularity image to be used.
@@ -130,6 +143,13 @@ OPTIONS
     --decaf-repo-branch BRANCH
         The branch to be checked out after cloning Decaf (see --decaf-repo).
 
+    --update-decaf
+        If the Decaf root directory already exists, fetch the latest commit of
+        BRANCH from REPO and check it out before building, leaving HEAD
+        detached at the fetched commit. Only clones that are already shallow
+        (like the ones made by this script) are fetched shallowly. Without this
+        option, an existing Decaf root directory is used as-is.
+
     --only-dependencies
         Only build the dependencies inside of Docker, without compiled Decaf.
 
@@ -137,6 +157,22 @@ OPTIONS
         Instead of building the whole set of dependencies, use the pre-built
         image TAG.
 
+    --tag-dependencies TAG
+        After building, also tag the dependencies of the image as TAG (and
+        push them like --tag does), to be used with --pull-dependencies later.
+        This reuses the layers from the first build, so it doesn't build the
+        dependencies a second time. Can't be combined with --only-dependencies
+        or --pull-dependencies.
+
+    --warm-cache
+        Instead of producing an image, only build the layers and push them as
+        a cache to USERNAME/IMAGENAME:cache-final, next to the --tag (which
+        must include a "/"), or to USERNAME/IMAGENAME:cache-dependencies with
+        --only-dependencies. Every build with a tag in that repository uses the
+        caches for its target and for the dependencies. Can't be combined with
+        --tag-dependencies. Exporting the cache needs a buildx builder using
+        the docker-container driver, e.g. from "docker buildx create --use".
+
 FILES
     go.sh
         A helper script used in the Dockerfile to run CMake with the correct
@@ -146,6 +182,15 @@ FILES
         A helper script that sets some variables to be used inside the go.sh
         script.
 
+    .dockerignore
+        Generated by build-docker-image to keep the .git directories and build
+        artifacts of the Decaf root directory out of the Docker build.
+
+    decaf-fermi-wrapper.sh
+        Generated by build-docker-image and installed as the entrypoint of the
+        image, as /usr/local/bin/decaf-fermi-wrapper. It takes one argument,
+        either "run" (the default) or "interactive".
+
 NOTES
     The build-docker-image and run-docker-image commands require Docker to be
     installed, but do not require Singularity installed. Likewise,
@@ -154,14 +199,60 @@ NOTES
     (provided the image is pushed to a registry, c.f. --tag option above with a
     "/" separator)
 
-BUGS
-    Currently, even if Python source code is changed, the hermetic build and
-    run process will rebuild everything, despite it being unnecessary for an
-    interpreted script. This could be fixed in one of two ways: 1) copy only
-    C++ source code first and then Python source code, or 2) build and run
-    incrementally.
+    The build-docker-image command uses BuildKit through "docker buildx",
+    which requires Docker 19.03 or newer with the buildx plugin.
 
 CHANGELOG
+    v0.3.0, unreleased
+        Build Decaf from a copy of the source tree with the Python sources
+        emptied out, then copy only the real Python sources over it, so that
+        changing only Python code no longer rebuilds all of Decaf.
+
+        Build with BuildKit and embed cache metadata in the image, using the
+        previously pushed images (see --tag and --pull-dependencies) as a
+        cache source, so that builds on a new machine can reuse their layers.
+
+        Keep the Spack, apt, and pip download caches in BuildKit cache mounts,
+        so that rebuilding the dependencies doesn't download everything again.
+
+        Remove the jinja2 dependency. The Dockerfile is now assembled from
+        plain strings, so this script only needs the Python standard library.
+
+        Install pythia8 along with the rest of the Spack environment instead of
+        in a second "spack install", and install pandas, networkx, and
+        apprentice after Rivet so that updating them doesn't rebuild Rivet.
+
+        Add the --tag-dependencies option, to tag and push the dependencies
+        from the same invocation that builds the whole image.
+
+        Install the script that sets up and runs the workflow into the image
+        as its entrypoint, instead of passing it to bash on every run. Images
+        built by previous versions can't be run by this version.
+
+        Run "spack install" and the Decaf build with one job per CPU.
+
+        Clone only the latest commit of Decaf, and add the --update-decaf
+        option to update an existing clone. A failure to check out the branch
+        is no longer ignored.
+
+        Build with "docker buildx" for the host's platform by default (see
+        --platform), so that the build doesn't silently run under emulation.
+
+        Generate the .dockerignore file, so that the .git directory and build
+        artifacts of the Decaf root directory aren't sent to Docker.
+
+        Generate decaf-henson.json once while building the image, with paths
+        relative to the directory the workflow is run from, instead of on
+        every run.
+
+        Set DECAF_PREFIX and LD_LIBRARY_PATH in the image instead of in the
+        run script, fixing a typo in how LD_LIBRARY_PATH was extended.
+
+        Add the --warm-cache option, to fill a build cache in the registry that
+        is shared by all builds; e.g. for CI jobs.
+
+        Fix run-singularity-image ignoring (and failing on) the --sif option.
+
     v0.2.6, 16 April 2021
         Add missing zlib package.
 
@@ -213,11 +304,12 @@ AUTHORS
     Tanner Hobson <thobson2@vols.utk.edu>
 """
 
-from subprocess import run
+import os
+import argparse
+from subprocess import run, Popen, PIPE, CalledProcessError
 from textwrap import dedent
 from pathlib import Path
-
-from jinja2 import Template
+from platform import machine
 
 
 setupscript = dedent("""\
@@ -233,7 +325,6 @@ hermeticscript = dedent("""\
     . /etc/profile
     #cat /.singularity.d/runscript -A
     set -euo pipefail
-    DECAF_PREFIX=/opt/decaf/stage
     DECAF_HENSON_PREFIX=${DECAF_PREFIX:?}/examples/henson
     FERMI_PREFIX=${DECAF_PREFIX:?}/examples/fermi_hep
     cd "$(TMPDIR=/tmp mktemp -d)"
@@ -245,29 +336,53 @@ hermeticscript = dedent("""\
 
     mkdir conf
     mv mb7tev.txt conf/
-    cp hep-fullWorkflow-inputPre.json ./decaf-henson.json
-    sed -ie 's!/home/oyildiz/mohan/fermi-workflow/install!'"$tmpdir/stage"'!g' ./decaf-henson.json
     #sed -ie 's!\\./!'"${FERMI_PREFIX:?}/"'!g' ./decaf-henson.json
     #cp "${FERMI_PREFIX:?}/hostfile_workflow.txt" ./hostfile_workflow.txt
     cp ../henson/python/decaf-henson_python ./decaf-henson_python
 
-    LD_LIBRARY_PATH=${LD_LIBRARY_PATH:+${LD_LIBRARY_PATH:?}:}${DECAF_PREFIX:?three}/lib
-    export DECAF_PREFIX LD_LIBRARY_PATH
     ls -lah
 """)
 
 
-runscript = dedent("""\
-    mpirun --hostfile hostfile_workflow.txt -np 4 ./decaf-henson_python
+# Installed into the image as the entrypoint, so that running the workflow
+# doesn't need the whole script passed in on every launch
+wrapperscript = dedent("""\
+    #!/usr/bin/env bash
+    case "${1:-run}" in
+    (run) cmd=(mpirun --hostfile hostfile_workflow.txt -np 4 ./decaf-henson_python);;
+    (interactive) cmd=(bash);;
+    (*) printf $'Usage: %s [run|interactive]\\n' "$0" >&2; exit 2;;
+    esac
+""") + setupscript + hermeticscript + dedent("""\
+    exec "${cmd[@]}"
+""")
+
+
+# Written to the build context before building, so that version control and
+# build artifacts in the decaf tree aren't sent to Docker or copied into the
+# image
+dockerignore = dedent("""\
+    /fermi_helper.py
+    /Dockerfile.staged
+    *.swp
+    *~
+    **/.git
+    **/__pycache__
+    **/*.pyc
+    **/*.o
+    **/CMakeFiles
+    **/CMakeCache.txt
+    /{decaf_root}/build
+    /{decaf_root}/stage
 """)
 
-intscript = dedent("""\
-    exec bash
+
+dockerfile_header = dedent("""\
+    # syntax=docker/dockerfile:1.4
 """)
 
 
-dockerfile_template = Template(dedent("""\
-    {% if not pull_dependencies %}
+dockerfile_dependencies = dedent("""\
     # Build stage with Spack pre-installed and ready to be used
     FROM spack/ubuntu-bionic:latest as builder
 
@@ -286,14 +401,19 @@ dockerfile_template = Template(dedent("""\
     &&   echo "  - automake" \\
     &&   echo "  - hepmc@2.06.10" \\
     &&   echo "  - diy@master ^mpich@3.3.2" \\
+    &&   echo "  - pythia8" \\
     &&   echo "  config:" \\
     &&   echo "    install_tree: /opt/software" \\
+    &&   echo "    build_stage: /opt/spack-cache/stage" \\
+    &&   echo "    source_cache: /opt/spack-cache/source" \\
     &&   echo "  concretization: together") > /opt/spack-environment/spack.yaml
 
-    # Install the software, remove unecessary deps
-    RUN cd /opt/spack-environment && spack --env . install && spack gc -y
-
-    RUN cd /opt/spack-environment && spack --env . add pythia8 && spack --env . install && spack gc -y
+    # Install the software, remove unecessary deps. Downloaded sources are
+    # kept in a cache mount, so they survive this layer being rebuilt. The job
+    # count is computed inside the RUN so it doesn't become part of the cache
+    # key
+    RUN --mount=type=cache,target=/opt/spack-cache \\
+        cd /opt/spack-environment && spack --env . install -j"$(nproc)" && spack gc -y
 
     ## Strip all the binaries
     #RUN find -L /opt/view/* -type f -exec readlink -f '{}' \; | \\
@@ -310,7 +430,9 @@ dockerfile_template = Template(dedent("""\
     # Bare OS image to run the installed executables
     FROM ubuntu:18.04 AS dependencies
 
-    RUN apt-get update && \\
+    RUN --mount=type=cache,target=/var/cache/apt,sharing=locked \\
+        rm -f /etc/apt/apt.conf.d/docker-clean && \\
+        apt-get update && \\
         apt-get install -y \\
             build-essential \\
             wget \\
@@ -325,15 +447,14 @@ dockerfile_template = Template(dedent("""\
     COPY --from=builder /opt/view /opt/view
     COPY --from=builder /etc/profile.d/z10_spack_environment.sh /etc/profile.d/z10_spack_environment.sh
 
-    RUN . /etc/profile && \\
+    # Cython is needed by rivet-bootstrap below to regenerate YODA's bindings
+    RUN --mount=type=cache,target=/root/.cache/pip \\
+        . /etc/profile && \\
         python3.8 -m ensurepip && \\
         python3.8 -m pip install virtualenv && \\
         python3.8 -m virtualenv /opt/venv && \\
         /opt/venv/bin/python -m pip install \\
-            pandas \\
-            networkx \\
             cython \\
-            git+https://github.com/HEPonHPC/apprentice.git@6fbf531c4cb6537ef6323e150b854541b0ce961d \\
         && \\
         echo '. /opt/venv/bin/activate' > /etc/profile.d/z15_python_environment.sh
 
@@ -347,20 +468,43 @@ dockerfile_template = Template(dedent("""\
         RIVET_VERSION=2.7.2 YODA_VERSION=1.7.5 HEPMC_VERSION=2.06.09 FASTJET_VERSION=3.3.2 ./rivet-bootstrap && \\
         echo '. /opt/rivet/local/rivetenv.sh' > /etc/profile.d/z20_rivet_environment.sh
 
-    {% endif %}
+    # Kept last, since the pinned apprentice commit changes more often than
+    # anything above
+    RUN --mount=type=cache,target=/root/.cache/pip \\
+        . /etc/profile && \\
+        /opt/venv/bin/python -m pip install \\
+            pandas \\
+            networkx \\
+            git+https://github.com/HEPonHPC/apprentice.git@6fbf531c4cb6537ef6323e150b854541b0ce961d
+""")
+
 
-    {% if pull_dependencies %}
-    FROM {{ pull_dependencies }} AS dependencies
-    {% endif %}
+dockerfile_pulled_dependencies = dedent("""\
+    FROM {pull_dependencies} AS dependencies
+""")
 
 
-    FROM dependencies AS final
+dockerfile_final = dedent("""\
+    # Copy of the source tree with the Python sources emptied out, so that
+    # editing them doesn't change what the compile layers below depend on
+    FROM dependencies AS sources
 
-    {% if not only_dependencies %}
+    COPY {decaf_root} /opt/decaf
+    RUN find /opt/decaf -type f -name '*.py' -print0 | xargs -0 --no-run-if-empty truncate -s 0
+
+    # And the opposite: only the Python sources, to be copied over the build.
+    # Copying the whole tree again would reset the C++ sources to the host's
+    # mtimes, which can be newer than the cached objects on another machine
+    FROM dependencies AS python-sources
+
+    COPY {decaf_root} /opt/decaf
+    RUN find /opt/decaf ! -type d ! -name '*.py' -delete
+
+    FROM dependencies AS final
 
     SHELL ["/bin/bash", "--rcfile", "/etc/profile", "-l", "-c"]
     WORKDIR /opt
-    COPY {{ decaf_root }} /opt/decaf
+    COPY --from=sources /opt/decaf /opt/decaf
     WORKDIR /opt/decaf
     COPY go.sh docker.env.sh /opt/decaf/
     RUN sed -ie '/extern "C" void \*(\*dlsym(void \*handle, const char \*symbol))();/d' /opt/view/include/Pythia8/PythiaStdlib.h && \\
@@ -370,69 +514,196 @@ dockerfile_template = Template(dedent("""\
     RUN . /etc/profile && \\
         . /opt/venv/bin/activate && \\
         ENV=docker ./go.sh cmake && \\
+        ENV=docker ./go.sh make -j"$(nproc)"
+
+    # Overlay the real Python sources. COPY restores their (older) host mtimes,
+    # so touch them to make anything generated from the empty copies, e.g. by
+    # configure_file, out of date again; the C++ objects are left as they are
+    COPY --from=python-sources /opt/decaf /opt/decaf
+    RUN find /opt/decaf \\( -path /opt/decaf/build -o -path /opt/decaf/stage \\) -prune -o \\
+            -type f -name '*.py' -print0 | xargs -0 --no-run-if-empty touch && \\
+        . /etc/profile && \\
+        . /opt/venv/bin/activate && \\
         ENV=docker ./go.sh make
 
-    {% endif %}
+    # The workflow is run from a copy of stage/examples/fermi_hep, so point it
+    # at that copy's stage directory rather than the author's install prefix
+    RUN cd /opt/decaf/stage/examples/fermi_hep && \\
+        sed -e 's!/home/oyildiz/mohan/fermi-workflow/install!../..!g' hep-fullWorkflow-inputPre.json > decaf-henson.json
 
-    ENTRYPOINT ["/bin/bash", "--rcfile", "/etc/profile"]
-    CMD ["-l"]
-"""))
+    ENV DECAF_PREFIX=/opt/decaf/stage
+    ENV LD_LIBRARY_PATH=${{LD_LIBRARY_PATH:+$LD_LIBRARY_PATH:}}/opt/decaf/stage/lib
 
+    COPY --chmod=755 decaf-fermi-wrapper.sh /usr/local/bin/decaf-fermi-wrapper
 
-def _make_script(interactive: bool) -> str:
-    script = setupscript
-    script += hermeticscript
+    ENTRYPOINT ["/usr/local/bin/decaf-fermi-wrapper"]
+    CMD ["run"]
+""")
 
-    if interactive:
-        script += intscript
-    else:
-        script += runscript
 
-    return script
+def _host_platform():
+    # Docker's names for the architectures that platform.machine() reports
+    arches = {
+        'x86_64': 'amd64',
+        'amd64': 'amd64',
+        'aarch64': 'arm64',
+        'arm64': 'arm64',
+        'armv7l': 'arm/v7',
+        'i386': '386',
+        'i686': '386',
+    }
+
+    # Leave it up to Docker rather than guess at a name it might not know
+    arch = arches.get(machine().lower())
+    if arch is None:
+        return None
+
+    return 'linux/{}'.format(arch)
+
+
+def _docker_build(tag, target, platform, output, cache_args, decaf_root, only_dependencies, pull_dependencies):
+    args = ['docker', 'buildx', 'build']
+    if platform:
+        args += ['--platform', str(platform)]
+
+    args += output + cache_args + ['--build-arg', 'BUILDKIT_INLINE_CACHE=1', '-t', str(tag), '-f', '-', '--target', str(target), '.']
+    proc = Popen(
+        args,
+        stdin=PIPE,
+    )
+
+    # Write the Dockerfile piece by piece instead of joining it up first
+    try:
+        with proc.stdin:
+            proc.stdin.write(dockerfile_header.encode('utf-8') + b'\n')
+
+            if pull_dependencies:
+                proc.stdin.write(dockerfile_pulled_dependencies.format(
+                    pull_dependencies=pull_dependencies,
+                ).encode('utf-8') + b'\n')
+            else:
+                proc.stdin.write(dockerfile_dependencies.encode('utf-8') + b'\n')
 
+            if not only_dependencies:
+                proc.stdin.write(dockerfile_final.format(
+                    decaf_root=decaf_root.relative_to(Path.cwd()),
+                ).encode('utf-8'))
+    except BrokenPipeError:
+        pass  # docker exited early, its exit status is checked below
 
-def main_build_docker_image(decaf_root, decaf_repo, decaf_repo_branch, tag, only_dependencies, pull_dependencies):
+    if proc.wait():
+        raise CalledProcessError(proc.returncode, args)
+
+
+def main_build_docker_image(decaf_root, decaf_repo, decaf_repo_branch, update_decaf, tag, platform, only_dependencies, pull_dependencies, tag_dependencies, warm_cache):
+    if warm_cache and '/' not in tag:
+        raise SystemExit('--warm-cache needs a registry tag (USERNAME/IMAGENAME:VERSION) to push the cache to')
+
+    if tag_dependencies and warm_cache:
+        raise SystemExit('--tag-dependencies has nothing to tag with --warm-cache, which produces no image')
+
+    if tag_dependencies and (only_dependencies or pull_dependencies):
+        raise SystemExit('--tag-dependencies only applies to full builds, without --only-dependencies or --pull-dependencies')
+
+    # Only the latest commit is needed to build, so skip the history
     if not decaf_root.exists():
         run(
-            ['git', 'clone', str(decaf_repo), str(decaf_root)],
+            ['git', 'clone', '--depth=1', '--branch', str(decaf_repo_branch), str(decaf_repo), str(decaf_root)],
             check=True,
         )
 
+    elif update_decaf:
+        # Keep clones made above shallow, but don't throw away the history of
+        # any other clone
+        shallow = run(
+            ['git', '-C', str(decaf_root), 'rev-parse', '--is-shallow-repository'],
+            stdout=PIPE,
+            universal_newlines=True,
+            check=True,
+        ).stdout.strip() == 'true'
+
+        if shallow:
+            depth = ['--depth=1']
+        else:
+            depth = []
+
         run(
-            ['git', 'checkout', str(decaf_repo_branch)],
-            cwd=decaf_root,
+            ['git', '-C', str(decaf_root), 'fetch'] + depth + [str(decaf_repo), str(decaf_repo_branch)],
+            check=True,
         )
 
-    dockerfile = dockerfile_template.render(
-        decaf_root=decaf_root.relative_to(Path.cwd()),
-        only_dependencies=only_dependencies,
-        pull_dependencies=pull_dependencies,
-    ).encode('utf-8')
+        run(
+            ['git', '-C', str(decaf_root), 'checkout', 'FETCH_HEAD'],
+            check=True,
+        )
 
     if only_dependencies:
         target = 'dependencies'
     else:
         target = 'final'
 
-    run(
-        ['docker', 'build', '-t', str(tag), '-f', '-', '--target', str(target), '.'],
-        input=dockerfile,
-        check=True,
-    )
+        # Copied into the image by the final stage
+        wrapper = Path.cwd() / 'decaf-fermi-wrapper.sh'
+        wrapper.write_text(wrapperscript)
 
+    (Path.cwd() / '.dockerignore').write_text(dockerignore.format(
+        decaf_root=decaf_root.relative_to(Path.cwd()),
+    ))
+
+    builds = [(tag, target)]
+    if tag_dependencies:
+        # Every layer is cached by the first build, so this only tags the
+        # dependencies stage
+        builds.append((tag_dependencies, 'dependencies'))
+
+    # Use the previously pushed images as a cache, so that a fresh machine
+    # doesn't have to rebuild every layer from scratch. BuildKit only fetches
+    # the layers it actually reuses
+    cache_from = [str(build_tag) for build_tag, _ in builds]
+    if pull_dependencies:
+        cache_from.append(str(pull_dependencies))
+
+    cache_args = []
+    for image in cache_from:
+        if '/' in image:
+            cache_args += ['--cache-from', image]
+
+    # Also use the caches exported by --warm-cache, which (unlike the inline
+    # cache) include the layers of the intermediate stages. Each target gets
+    # its own ref, since exporting a cache replaces whatever the ref held
     if '/' in tag:
-        run(
-            ['docker', 'push', str(tag)],
-            check=True,
-        )
+        repository = tag.rsplit(':', 1)[0]
+        cache_targets = ['dependencies']
+        if target != 'dependencies':
+            cache_targets.append(target)
+
+        for cache_target in cache_targets:
+            cache_args += ['--cache-from', 'type=registry,ref={}:cache-{}'.format(repository, cache_target)]
+
+        if warm_cache:
+            cache_args += ['--cache-to', 'type=registry,ref={}:cache-{},mode=max'.format(repository, target)]
+
+    for build_tag, build_target in builds:
+        if warm_cache:
+            output = ['--output', 'type=cacheonly']
+        elif '/' in build_tag:
+            output = ['--push']
+        else:
+            output = ['--load']
+
+        _docker_build(build_tag, build_target, platform, output, cache_args, decaf_root, only_dependencies, pull_dependencies)
 
 
 def main_run_docker_image(tag, interactive):
-    script = _make_script(interactive)
+    if interactive:
+        mode = 'interactive'
+    else:
+        mode = 'run'
 
-    run(
-        ['docker', 'run', '-it', '--rm', '--mount', 'type=bind,src=' + str(Path.cwd()) + ',dst=' + str(Path.cwd()), str(tag), '--rcfile', '/etc/profile', '-c', script, 'decaf-fermi-wrapper'],
-        check=True,
+    # Replace this process, rather than waiting around for the whole run
+    os.execvp(
+        'docker',
+        ['docker', 'run', '-it', '--rm', '--mount', 'type=bind,src=' + str(Path.cwd()) + ',dst=' + str(Path.cwd()), str(tag), mode],
     )
 
 
@@ -448,12 +719,16 @@ def main_build_singularity_image(tag, sif):
     )
 
 
-def main_run_singularity_image(interactive):
-    script = _make_script(interactive)
+def main_run_singularity_image(sif, interactive):
+    if interactive:
+        mode = 'interactive'
+    else:
+        mode = 'run'
 
-    run(
-        ['singularity', 'exec', './decaf-fermi.sif', 'bash', '--rcfile', '/etc/profile', '-c', script, 'decaf-fermi-wrapper'],
-        check=True,
+    # Replace this process, rather than waiting around for the whole run
+    os.execvp(
+        'singularity',
+        ['singularity', 'exec', str(sif), '/usr/local/bin/decaf-fermi-wrapper', mode],
     )
 
 
@@ -481,8 +756,6 @@ def cli():
         assert path.parent.exists(), 'Expected parent directory to exist: {}'.format(path.parent)
         return path
 
-    import argparse
-
     parser = argparse.ArgumentParser()
     parser.set_defaults(main=None)
     subparsers = parser.add_subparsers()
@@ -492,10 +765,16 @@ def cli():
     subparser.add_argument('--decaf-root', type=Path, default=Path.cwd() / 'decaf')
     subparser.add_argument('--decaf-repo', default='git@bitbucket.org:tpeterka1/decaf.git')
     subparser.add_argument('--decaf-repo-branch', default='fermi-workflow')
+    subparser.add_argument('--update-decaf', action='store_true')
     subparser.add_argument('--tag', default='decaf-fermi:latest', type=tag,
                            help='e.g. MyUsername/MyImage:latest or my.registry.example.com:5000/MyUsername/MyImage:latest')
+    subparser.add_argument('--platform', default=_host_platform(),
+                           help='e.g. linux/amd64 or linux/arm64')
     subparser.add_argument('--only-dependencies', action='store_true')
     subparser.add_argument('--pull-dependencies', type=tag)
+    subparser.add_argument('--tag-dependencies', type=tag,
+                           help='e.g. MyUsername/MyImage:latest-base')
+    subparser.add_argument('--warm-cache', action='store_true')
 
     subparser = subparsers.add_parser('run-docker-image')
     subparser.set_defaults(main=main_run_docker_image)